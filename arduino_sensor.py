@@ -1,12 +1,22 @@
 import serial
 import time
 import sys
-import psycopg2
-from psycopg2 import sql, Error
+import psycopg
+from psycopg import Error, DataError, IntegrityError
 from datetime import datetime
 import os
 from dotenv import load_dotenv
 import re
+import logging
+import bisect
+import math
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+log = logging.getLogger('sensor')
 
 # 載入環境變數，指定編碼
 try:
@@ -25,7 +35,7 @@ class DatabaseConfig:
         """本地 PostgreSQL 配置"""
         return {
             'host': 'localhost',
-            'database': 'sensor_data',
+            'dbname': 'sensor_data',
             'user': 'postgres',
             'password': 'c5718!ak',
             'port': '5432'
@@ -47,7 +57,8 @@ class SerialDataReader:
         self.baudrate = baudrate
         self.timeout = timeout
         self.serial_connection = None
-        self.encoding_list = ['utf-8', 'big5', 'gb2312', 'ascii', 'latin1']
+        # 不可見控制字元（保留 \t \n \r），解碼前直接以 bytes.translate 移除
+        self._delete_bytes = bytes(b for b in range(32) if b not in (9, 10, 13))
     
     def connect(self):
         """建立串列埠連接"""
@@ -67,47 +78,25 @@ class SerialDataReader:
             return False
     
     def safe_decode(self, raw_data):
-        """安全解碼資料，嘗試多種編碼方式"""
+        """安全解碼資料：移除控制字元後以 UTF-8 解碼（保留「初始化」等系統訊息）"""
         if not raw_data:
             return ""
         
-        # 嘗試不同的編碼方式
-        for encoding in self.encoding_list:
-            try:
-                decoded = raw_data.decode(encoding, errors='ignore').strip()
-                if decoded:  # 確保解碼後有內容
-                    return decoded
-            except (UnicodeDecodeError, AttributeError):
-                continue
-        
-        # 如果所有編碼都失敗，使用 errors='replace' 來替換錯誤字符
-        try:
-            decoded = raw_data.decode('utf-8', errors='replace').strip()
-            if decoded:
-                return decoded
-        except:
-            pass
-        
-        # 最後的備用方案：使用 latin1 並清理不可見字符
-        try:
-            decoded = raw_data.decode('latin1', errors='ignore').strip()
-            # 清理不可見字符，只保留可印字符
-            cleaned = ''.join(char for char in decoded if ord(char) >= 32 or char in ['\t', '\n', '\r'])
-            return cleaned
-        except:
-            return ""
+        # 無法解碼的位元組以替代字元表示，不會產生解碼錯誤
+        return raw_data.translate(None, self._delete_bytes).decode('utf-8', 'replace').strip()
     
     def read_line(self):
-        """讀取一行資料"""
+        """讀取一行資料
+        
+        直接阻塞在 readline() 上，收到資料即返回，最多等待 timeout 秒；
+        逾時返回空字串，未連接或發生錯誤返回 None。
+        """
         if not self.serial_connection or not self.serial_connection.is_open:
             return None
         
         try:
-            if self.serial_connection.in_waiting > 0:
-                raw_data = self.serial_connection.readline()
-                if raw_data:
-                    decoded_data = self.safe_decode(raw_data)
-                    return decoded_data
+            raw_data = self.serial_connection.readline()
+            return self.safe_decode(raw_data)
         except Exception as e:
             print(f"⚠️  讀取資料時發生錯誤: {e}")
         
@@ -128,10 +117,15 @@ class SensorDataParser:
     """感測器資料解析器 - 添加詳細調試"""
     
     def __init__(self):
-        # 擴展正則表達式模式來匹配更多可能的NTU格式
-        self.ph_pattern = re.compile(r'pH[_\s]*value:?\s*(-?\d+\.?\d*)', re.IGNORECASE)
-        self.orp_pattern = re.compile(r'ORP:?\s*(-?\d+)', re.IGNORECASE)
-        self.ntu_pattern = re.compile(r'(?:Turbidity|NTU):?\s*(-?\d+)', re.IGNORECASE)
+        # 擴展正則表達式模式來匹配更多可能的NTU格式，合併為單一模式只需掃描一次
+        self.sensor_pattern = re.compile(
+            r'(?:pH[_\s]*value:?\s*(?P<ph>-?\d+\.?\d*))'
+            r'|(?:ORP:?\s*(?P<orp>-?\d+))'
+            r'|(?:(?:Turbidity|NTU):?\s*(?P<ntu>-?\d+))',
+            re.IGNORECASE
+        )
+        # 不可見字元刪除表（保留 \t \n \r）
+        self._delete_table = dict.fromkeys(i for i in range(32) if i not in (9, 10, 13))
     
     def parse_sensor_data(self, data_string):
         """解析感測器資料字符串 - 添加詳細調試"""
@@ -139,31 +133,25 @@ class SensorDataParser:
             return None, None, None
         
         # 清理不可見字元
-        cleaned_data = ''.join(c for c in data_string if ord(c) >= 32 or c in '\t\n\r')
+        cleaned_data = data_string.translate(self._delete_table)
         
         ph_value = None
         orp_value = None
         ntu_value = None
         
-        ph_match = self.ph_pattern.search(cleaned_data)
-        if ph_match:
-            try:
-                ph_value = float(ph_match.group(1))
-            except:
-                pass
-        
-        orp_match = self.orp_pattern.search(cleaned_data)
-        if orp_match:
+        # 每個欄位只採用第一次出現的數值
+        for match in self.sensor_pattern.finditer(cleaned_data):
             try:
-                orp_value = int(orp_match.group(1))
-            except:
-                pass
-        
-        ntu_match = self.ntu_pattern.search(cleaned_data)
-        if ntu_match:
-            try:
-                ntu_value = int(ntu_match.group(1))
-            except:
+                if match.group('ph') is not None:
+                    if ph_value is None:
+                        ph_value = float(match.group('ph'))
+                elif match.group('orp') is not None:
+                    if orp_value is None:
+                        orp_value = int(match.group('orp'))
+                elif match.group('ntu') is not None:
+                    if ntu_value is None:
+                        ntu_value = int(match.group('ntu'))
+            except ValueError:
                 pass
         
         return ph_value, orp_value, ntu_value
@@ -186,14 +174,60 @@ class SensorDataParser:
         
         return warnings
 
+class ReadingHistory:
+    """保存最近的讀取值，並以累加和維護最近幾次的平均值"""
+    
+    def __init__(self, maxlen=50, window=5):
+        self.readings = deque(maxlen=maxlen)
+        self.window = deque(maxlen=window)
+        self.window_sum = 0
+    
+    def append(self, value):
+        """加入一筆讀取值，O(1) 更新最近幾次的累加和"""
+        if len(self.window) == self.window.maxlen:
+            self.window_sum -= self.window[0]
+        self.window.append(value)
+        self.window_sum += value
+        self.readings.append(value)
+    
+    def window_average(self):
+        """最近幾次的平均值，資料不足時返回 None"""
+        if len(self.window) < self.window.maxlen:
+            return None
+        return self.window_sum / len(self.window)
+
 class SensorDatabase:
     """感測器資料庫操作類別 - 添加詳細調試"""
     
+    # 狀態門檻與對應標籤，以 bisect 查表取代 if-else 判斷
+    # pH：< 6.5 酸性、6.5 ~ 7.5 中性、> 7.5 鹼性（上限 7.5 仍屬中性）
+    _PH_TH = (6.5, math.nextafter(7.5, math.inf))
+    _PH_LBL = ("酸性", "中性", "鹼性")
+    # ORP：<= 0 還原性、<= 300 弱氧化性、<= 650 氧化性、> 650 強氧化性
+    _ORP_TH = (0, 300, 650)
+    _ORP_LBL = ("還原性", "弱氧化性", "氧化性", "強氧化性")
+    
     def __init__(self, config_type='local'):
         self.config_type = config_type
         self.connection = None
         self.cursor = None
         
+        # 寫入語句只建立一次，供每次批次寫入重複使用
+        self._insert_sql = (
+            "INSERT INTO sensor_readings "
+            "(timestamp,ph_value,orp_value,ntu_value,ph_status,orp_status,water_quality_good) "
+            "VALUES (%s,%s,%s,%s,%s,%s,%s)"
+        )
+        
+        # 寫入緩衝區：寫入執行緒在佇列清空時立即寫入，負載高時批次自然變大；
+        # 筆數與時間間隔只是持續有資料進來時的上限
+        self._pending = []
+        self._last_flush_time = time.time()
+        self.flush_size = 20
+        self.flush_interval = 1  # 秒
+        self.bulk_threshold = 200  # 累積過多時改用 COPY 寫入
+        self.max_pending = 5000    # 緩衝區上限；達到上限時寫入執行緒暫停從佇列取資料
+        
         try:
             if config_type == 'local':
                 self.config = DatabaseConfig.get_local_config()
@@ -212,12 +246,13 @@ class SensorDatabase:
             if self.config_type == 'render':
                 print(f"   使用 DATABASE_URL 連線字串")
                 # 用完整連線字串連線，並強制 sslmode
-                self.connection = psycopg2.connect(self.config, sslmode='require')
+                self.connection = psycopg.connect(self.config, sslmode='require')
             else:
                 # local 用字典設定連線
-                self.connection = psycopg2.connect(**self.config)
+                self.connection = psycopg.connect(**self.config)
             
-            self.cursor = self.connection.cursor()
+            # 以二進位格式傳送參數，數值不需在用戶端與伺服器間轉為文字
+            self.cursor = self.connection.cursor(binary=True)
             self.cursor.execute("SELECT version();")
             version = self.cursor.fetchone()
             print(f"✅ 成功連接到 {self.config_type} PostgreSQL 資料庫")
@@ -234,14 +269,20 @@ class SensorDatabase:
             return False
     
     def check_connection(self):
-        """檢查連線是否仍然有效"""
-        try:
-            if self.connection and not self.connection.closed:
-                self.cursor.execute("SELECT 1;")
-                return True
-            return False
-        except Error:
-            return False
+        """檢查連線是否仍然有效
+        
+        不另外發送 SELECT 1（每次寫入會多一次網路往返）；連線中斷時 psycopg 會在
+        寫入失敗後將連線標記為 broken，下一次寫入前再重新連線。
+        """
+        return bool(self.connection and not self.connection.closed and not self.connection.broken)
+    
+    def rollback(self):
+        """回復目前的交易；連線已中斷時略過"""
+        if self.check_connection():
+            try:
+                self.connection.rollback()
+            except Error as e:
+                log.error("❌ 回復交易失敗: %s", e)
     
     def reconnect(self):
         """重新連線"""
@@ -268,8 +309,15 @@ class SensorDatabase:
         );
         """
         
+        # 最新/歷史查詢皆依 timestamp DESC 排序，建立索引避免全表掃描與排序
+        create_index_query = """
+        CREATE INDEX IF NOT EXISTS sensor_readings_ts_desc
+        ON sensor_readings (timestamp DESC);
+        """
+        
         try:
             self.cursor.execute(create_table_query)
+            self.cursor.execute(create_index_query)
             self.connection.commit()
             print("✅ 資料表建立/確認完成")
             return True
@@ -277,92 +325,186 @@ class SensorDatabase:
             print(f"❌ 建立資料表失敗: {e}")
             return False
     
-    def save_sensor_data(self, ph_value, orp_value, ntu_value=None):
-        """儲存感測器資料到資料庫 - 添加詳細調試"""
+    def save_sensor_data(self, ph_value, orp_value, ntu_value=None, timestamp=None):
+        """將感測器資料加入寫入緩衝區，達到門檻時批次寫入資料庫
+        
+        timestamp 為讀取時間；未提供時使用目前時間。
+        """
+        # 詳細記錄準備寫入的數值（僅在調試模式下輸出）
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("💾 準備寫入資料庫的數值: pH: %r (type: %s) | ORP: %r (type: %s) | NTU: %r (type: %s)",
+                      ph_value, type(ph_value), orp_value, type(orp_value),
+                      ntu_value, type(ntu_value))
+        
+        # 計算狀態
+        ph_status = None
+        if ph_value is not None:
+            ph_status = self._PH_LBL[bisect.bisect_right(self._PH_TH, ph_value)]
+        orp_status = None
+        if orp_value is not None:
+            orp_status = self._ORP_LBL[bisect.bisect_left(self._ORP_TH, orp_value)]
+        # 判斷水質是否良好
+        water_quality_good = None
+        if ph_value is not None and orp_value is not None:
+            water_quality_good = 6.5 <= ph_value <= 8.5 and 200 <= orp_value <= 800
+        
+        self._pending.append((
+            timestamp or datetime.now(),
+            ph_value,
+            orp_value,
+            ntu_value,
+            ph_status,
+            orp_status,
+            water_quality_good
+        ))
+        
+        return self.flush_if_due()
+    
+    def pending_full(self):
+        """緩衝區是否已達上限（例如資料庫中斷時持續累積）"""
+        return len(self._pending) >= self.max_pending
+    
+    def flush_if_due(self):
+        """緩衝區達到筆數門檻或超過時間間隔時才寫入資料庫"""
+        # 未達筆數門檻且未超過時間間隔時，先保留在緩衝區
+        if (len(self._pending) < self.flush_size and
+                time.time() - self._last_flush_time < self.flush_interval):
+            return True
+        
+        return self.flush_pending()
+    
+    def flush_pending(self):
+        """立即寫入緩衝區內的資料"""
+        # 例如資料庫中斷後累積大量資料，改用 COPY 一次寫入
+        if len(self._pending) >= self.bulk_threshold:
+            return self.flush_bulk()
+        return self.flush()
+    
+    def flush(self):
+        """將緩衝區內的資料以單一批次寫入資料庫"""
+        if not self._pending:
+            return True
+        
         try:
             # 檢查連線狀態
             if not self.check_connection():
-                print("⚠️  資料庫連線中斷，嘗試重新連線...")
+                log.warning("⚠️  資料庫連線中斷，嘗試重新連線...")
                 if not self.reconnect():
-                    print("❌ 重新連線失敗，無法儲存資料")
+                    log.error("❌ 重新連線失敗，%d 筆資料保留在緩衝區", len(self._pending))
                     return False
             
-            # 詳細記錄準備寫入的數值
-            print(f"💾 準備寫入資料庫的數值:")
-            print(f"   pH: {ph_value} (type: {type(ph_value)})")
-            print(f"   ORP: {orp_value} (type: {type(orp_value)})")
-            print(f"   NTU: {ntu_value} (type: {type(ntu_value)})")
-            
-            # 計算狀態
-            ph_status = self._get_ph_status(ph_value) if ph_value is not None else None
-            orp_status = self._get_orp_status(orp_value) if orp_value is not None else None
-            water_quality_good = self._is_water_quality_good(ph_value, orp_value)
-            
-            insert_query = """
-            INSERT INTO sensor_readings (
-                timestamp, ph_value, orp_value, ntu_value, 
-                ph_status, orp_status, water_quality_good
-            )
-            VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
-            
-            values = (
-                datetime.now(),
-                ph_value,
-                orp_value,
-                ntu_value,
-                ph_status,
-                orp_status,
-                water_quality_good
-            )
+            # 在 pipeline 模式中排入 INSERT、NOTIFY 與 COMMIT，一次網路往返送出
+            with self.connection.pipeline():
+                self.cursor.executemany(self._insert_sql, self._pending)
+                self._notify_latest(self._pending[-1])
+                self.connection.commit()
             
-            #print(f"💾 SQL 查詢: {insert_query}")
-            #print(f"💾 參數值: {values}")
+            log.debug("💾 %d 筆資料已儲存到資料庫", len(self._pending))
+            self._pending = []
+            self._last_flush_time = time.time()
+            return True
             
-            self.cursor.execute(insert_query, values)
-            self.connection.commit()
+        except (DataError, IntegrityError) as e:
+            # 資料本身被拒絕（例如數值超出欄位範圍），重試整批也不會成功
+            log.error("❌ 批次資料被資料庫拒絕，改為逐筆寫入: %s", e)
+            self.connection.rollback()
+            return self.flush_rows_individually()
+        except Error as e:
+            log.error("❌ 儲存資料失敗: %s", e)
+            self.rollback()
+            return False
+    
+    def _notify_latest(self, row):
+        """在同一交易中發送 NOTIFY，通知 API 端有新資料（交易提交時才會送出）"""
+        timestamp, ph_value, orp_value, ntu_value = row[:4]
+        payload = {
+            "timestamp": timestamp.isoformat(),
+            # 與資料表的 DECIMAL(4,2) 精度一致
+            "ph_value": round(ph_value, 2) if ph_value is not None else None,
+            "orp_value": orp_value,
+            "ntu_value": ntu_value
+        }
+        # NOTIFY 不接受參數綁定，改用 pg_notify()
+        self.cursor.execute("SELECT pg_notify('sensor_new', %s)", (json.dumps(payload),))
+    
+    def bulk_copy(self, rows):
+        """使用 COPY FROM STDIN 批次寫入大量資料"""
+        copy_query = """
+        COPY sensor_readings (
+            timestamp, ph_value, orp_value, ntu_value, 
+            ph_status, orp_status, water_quality_good
+        ) FROM STDIN
+        """
+        
+        # write_row 會依 COPY 格式處理 NULL 與跳脫字元（COPY 不支援 pipeline 模式）
+        with self.cursor.copy(copy_query) as copy:
+            for row in rows:
+                copy.write_row(row)
+        self._notify_latest(rows[-1])
+        self.connection.commit()
+    
+    def flush_bulk(self):
+        """將緩衝區內的大量資料以 COPY 寫入資料庫"""
+        if not self._pending:
+            return True
+        
+        try:
+            # 檢查連線狀態
+            if not self.check_connection():
+                log.warning("⚠️  資料庫連線中斷，嘗試重新連線...")
+                if not self.reconnect():
+                    log.error("❌ 重新連線失敗，%d 筆資料保留在緩衝區", len(self._pending))
+                    return False
             
-            # 驗證資料是否正確插入
-            self.cursor.execute("SELECT * FROM sensor_readings ORDER BY id DESC LIMIT 1;")
-            last_record = self.cursor.fetchone()
-            if last_record:
-                print(f"💾 最新插入的記錄: {last_record}")
+            self.bulk_copy(self._pending)
             
-            print(f"💾 資料已儲存到資料庫: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            log.debug("💾 %d 筆資料已以 COPY 儲存到資料庫", len(self._pending))
+            self._pending = []
+            self._last_flush_time = time.time()
             return True
             
+        except (DataError, IntegrityError) as e:
+            # 資料本身被拒絕（例如數值超出欄位範圍），重試整批也不會成功
+            log.error("❌ 批次資料被資料庫拒絕，改為逐筆寫入: %s", e)
+            self.connection.rollback()
+            return self.flush_rows_individually()
         except Error as e:
-            print(f"❌ 儲存資料失敗: {e}")
-            if self.connection:
-                self.connection.rollback()
+            log.error("❌ 批次儲存資料失敗: %s", e)
+            self.rollback()
             return False
     
-    def _get_ph_status(self, ph_value):
-        """取得pH狀態"""
-        if ph_value < 6.5:
-            return "酸性"
-        elif ph_value > 7.5:
-            return "鹼性"
-        else:
-            return "中性"
-    
-    def _get_orp_status(self, orp_value):
-        """取得ORP狀態"""
-        if orp_value > 650:
-            return "強氧化性"
-        elif orp_value > 300:
-            return "氧化性"
-        elif orp_value > 0:
-            return "弱氧化性"
-        else:
-            return "還原性"
-    
-    def _is_water_quality_good(self, ph_value, orp_value):
-        """判斷水質是否良好"""
-        if ph_value is None or orp_value is None:
-            return None
-        return (ph_value >= 6.5 and ph_value <= 8.5 and 
-                orp_value >= 200 and orp_value <= 800)
+    def flush_rows_individually(self):
+        """逐筆寫入緩衝區內的資料，捨棄被資料庫拒絕的記錄
+        
+        連線錯誤時停止，尚未寫入的資料保留在緩衝區。
+        """
+        written = 0
+        last_row = None
+        try:
+            for row in self._pending:
+                try:
+                    self.cursor.execute(self._insert_sql, row)
+                    self.connection.commit()
+                    last_row = row
+                except (DataError, IntegrityError) as e:
+                    self.connection.rollback()
+                    log.error("❌ 捨棄無法寫入的資料 %s: %s", row, e)
+                written += 1
+            
+            if last_row:
+                self._notify_latest(last_row)
+                self.connection.commit()
+            
+        except Error as e:
+            log.error("❌ 逐筆儲存資料失敗: %s", e)
+            self.rollback()
+            return False
+        finally:
+            # 已處理（寫入或捨棄）的資料移出緩衝區
+            del self._pending[:written]
+        
+        self._last_flush_time = time.time()
+        return True
     
     def close(self):
         """關閉資料庫連接"""
@@ -372,6 +514,39 @@ class SensorDatabase:
             self.connection.close()
         print("🔒 資料庫連接已關閉")
 
+def database_writer_loop(db, write_queue, stop_event):
+    """背景寫入執行緒：從佇列取出讀取值並寫入資料庫，避免阻塞串列埠讀取"""
+    while not stop_event.is_set() or not write_queue.empty():
+        try:
+            if db.pending_full():
+                # 緩衝區已滿時不再從佇列取資料，佇列滿後由讀取端捨棄新資料並發出警告，
+                # 記憶體用量因此有上限
+                if db.flush_pending():
+                    continue
+                if stop_event.is_set():
+                    log.error("❌ 資料庫無法寫入，捨棄佇列內剩餘的 %d 筆資料", write_queue.qsize())
+                    break
+                stop_event.wait(1)
+                continue
+            
+            try:
+                timestamp, ph_value, orp_value, ntu_value = write_queue.get(timeout=1)
+            except queue.Empty:
+                # 沒有新資料時，仍依時間間隔寫入緩衝區內的資料
+                db.flush_if_due()
+                continue
+            
+            if not db.save_sensor_data(ph_value, orp_value, ntu_value, timestamp):
+                log.error("❌ 資料儲存失敗")
+            elif write_queue.empty():
+                # 沒有待處理的讀取值時立即寫入，讓新資料（與 NOTIFY）盡快送達
+                if not db.flush_pending():
+                    log.error("❌ 資料儲存失敗")
+        except Exception as e:
+            log.error("❌ 資料庫寫入執行緒發生錯誤: %s", e)
+    
+    db.flush_pending()
+
 def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
     """讀取Arduino感測器資料並儲存到PostgreSQL"""
     
@@ -398,6 +573,12 @@ def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
         db.close()
         return
     
+    # 資料庫寫入交由背景執行緒處理；佇列已滿時捨棄新資料並發出警告
+    write_queue = queue.Queue(maxsize=1024)
+    stop_event = threading.Event()
+    writer = ThreadPoolExecutor(max_workers=1)
+    writer.submit(database_writer_loop, db, write_queue, stop_event)
+    
     try:
         # 等待Arduino初始化
         print("⏳ 等待Arduino初始化...")
@@ -410,9 +591,9 @@ def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
         print("=" * 70)
         
         # 用來儲存歷史資料
-        ph_readings = []
-        orp_readings = []
-        ntu_readings = []
+        ph_readings = ReadingHistory()
+        orp_readings = ReadingHistory()
+        ntu_readings = ReadingHistory()
         
         consecutive_errors = 0
         max_consecutive_errors = 10
@@ -421,15 +602,15 @@ def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
             # 讀取資料
             raw_data = serial_reader.read_line()
             
+            # 讀取頻率由 readline 的資料到達決定；僅在串列埠中斷或讀取錯誤時稍候，避免空轉
             if raw_data is None:
-                time.sleep(0.1)
+                time.sleep(1)
                 continue
             
-            if not raw_data:  # 空字符串
-                time.sleep(0.1)
+            if not raw_data:  # 空字符串（readline 逾時，已等待過）
                 continue
             
-            print(f"📡 原始資料: {repr(raw_data)}")
+            log.debug("📡 原始資料: %r", raw_data)
             
             # 解析資料
             ph_value, orp_value, ntu_value = data_parser.parse_sensor_data(raw_data)
@@ -441,12 +622,10 @@ def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
                 # 驗證數值
                 warnings = data_parser.validate_sensor_values(ph_value, orp_value, ntu_value)
                 
-                if warnings:
-                    print(f"⚠️  資料驗證警告:")
-                    for warning in warnings:
-                        print(f"   - {warning}")
+                for warning in warnings:
+                    log.warning("⚠️  資料驗證警告: %s", warning)
                 
-                # 儲存有效的讀取值
+                # 儲存有效的讀取值（保持最近50個讀取值）
                 if ph_value is not None:
                     ph_readings.append(ph_value)
                 if orp_value is not None:
@@ -454,68 +633,50 @@ def read_arduino_data(port='COM3', baudrate=9600, timeout=1, db_type='local'):
                 if ntu_value is not None:
                     ntu_readings.append(ntu_value)
                 
-                # 保持最近50個讀取值
-                if len(ph_readings) > 50:
-                    ph_readings.pop(0)
-                if len(orp_readings) > 50:
-                    orp_readings.pop(0)
-                if len(ntu_readings) > 50:
-                    ntu_readings.pop(0)
-                
-                # 顯示解析後的資料
-                result_parts = []
-                if ph_value is not None:
-                    result_parts.append(f"pH: {ph_value:.2f}")
-                if orp_value is not None:
-                    result_parts.append(f"ORP: {orp_value}mV")
-                if ntu_value is not None:
-                    result_parts.append(f"NTU: {ntu_value}")
-                
-                print(f"📊 解析結果: {' | '.join(result_parts)}")
-                
-                # 儲存資料到資料庫
-                if db.save_sensor_data(ph_value, orp_value, ntu_value):
-                    print("✅ 資料儲存成功")
+                # 排入資料庫寫入佇列
+                try:
+                    write_queue.put_nowait((datetime.now(), ph_value, orp_value, ntu_value))
+                except queue.Full:
+                    log.warning("⚠️  寫入佇列已滿，捨棄此筆資料")
                 else:
-                    print("❌ 資料儲存失敗")
-                
-                # 計算平均值
-                if len(ph_readings) >= 5:
-                    avg_ph = sum(ph_readings[-5:]) / 5
-                    print(f"📈 最近5次pH平均值: {avg_ph:.2f}")
-                
-                if len(orp_readings) >= 5:
-                    avg_orp = sum(orp_readings[-5:]) / 5
-                    print(f"📈 最近5次ORP平均值: {avg_orp:.0f}mV")
+                    # 每筆讀取值只輸出一行 INFO
+                    log.info("📊 pH=%s ORP=%s NTU=%s", ph_value, orp_value, ntu_value)
                 
-                if len(ntu_readings) >= 5:
-                    avg_ntu = sum(ntu_readings[-5:]) / 5
-                    print(f"📈 最近5次NTU平均值: {avg_ntu:.0f}")
-                
-                print("-" * 70)
+                # 計算平均值（僅在調試模式下輸出）
+                if log.isEnabledFor(logging.DEBUG):
+                    avg_ph = ph_readings.window_average()
+                    if avg_ph is not None:
+                        log.debug("📈 最近5次pH平均值: %.2f", avg_ph)
+                    
+                    avg_orp = orp_readings.window_average()
+                    if avg_orp is not None:
+                        log.debug("📈 最近5次ORP平均值: %.0fmV", avg_orp)
+                    
+                    avg_ntu = ntu_readings.window_average()
+                    if avg_ntu is not None:
+                        log.debug("📈 最近5次NTU平均值: %.0f", avg_ntu)
                 
             else:
                 consecutive_errors += 1
-                print(f"⚠️  無法解析資料 (連續錯誤: {consecutive_errors}/{max_consecutive_errors})")
+                log.warning("⚠️  無法解析資料 (連續錯誤: %d/%d)", consecutive_errors, max_consecutive_errors)
                 
                 if consecutive_errors >= max_consecutive_errors:
-                    print("❌ 連續解析錯誤過多，請檢查Arduino程式或連接")
+                    log.error("❌ 連續解析錯誤過多，請檢查Arduino程式或連接")
                     break
                 
                 # 其他系統訊息
                 if "初始化" in raw_data or "sensor" in raw_data.lower():
-                    print(f"📝 系統訊息: {raw_data}")
+                    log.info("📝 系統訊息: %s", raw_data)
                     consecutive_errors = 0  # 重置錯誤計數
             
-            # 短暫延遲
-            time.sleep(5)
-            
     except KeyboardInterrupt:
         print("\n⏹️  程式已停止")
     except Exception as e:
         print(f"❌ 發生未預期錯誤: {e}")
     finally:
-        # 清理資源
+        # 清理資源：等待寫入執行緒寫完佇列內剩餘的資料
+        stop_event.set()
+        writer.shutdown(wait=True)
         serial_reader.close()
         db.close()
 
@@ -551,6 +712,8 @@ def test_database_connection(db_type):
         return False
 
 def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    
     print("🔬 Arduino 感測器資料讀取程式 (NTU調試版)")
     print("=" * 50)
     
@@ -1,9 +1,20 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from routers.api_v1.routers import router
+from routers.api_v1.endpoints import data, data1
 
-app = FastAPI()
+# 啟動時建立資料庫連線池與檔案監看工作，關閉時釋放
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await data.init_pool()
+    data1.start_publisher()
+    yield
+    await data1.stop_publisher()
+    await data.close_pool()
+
+app = FastAPI(lifespan=lifespan)
 
 # 設定模板資料夾
 templates = Jinja2Templates(directory="templates")
@@ -14,4 +25,14 @@ app.include_router(router, prefix="/api/v1")
 # 新增一個路由，回傳 HTML 頁面
 @app.get("/", response_class=templates.TemplateResponse)
 async def home(request: Request):
-    return templates.TemplateResponse("index_test.html", {"request": request})
\ No newline at end of file
+    return templates.TemplateResponse("index_test.html", {"request": request})
+
+# 直接執行時，在支援的平台上使用 uvloop 事件迴圈（Windows 不支援，維持 asyncio）
+if __name__ == "__main__":
+    import uvicorn
+    try:
+        import uvloop
+        loop = "uvloop"
+    except ImportError:
+        loop = "asyncio"
+    uvicorn.run(app, loop=loop)
@@ -3,8 +3,9 @@ from fastapi.responses import StreamingResponse
 import asyncio
 import asyncpg
 import json
+import time
 from datetime import datetime
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Set
 import os
 from dotenv import load_dotenv
 
@@ -37,48 +38,204 @@ else:
 
 # 快取變數
 cached_data = None
-last_cache_time = None
+last_cache_time = None  # time.monotonic() 時間
 cache_duration = 5  # 快取持續時間（秒）
 last_sent_data = None
+replace_frame_cache = None  # (數據鍵值, 已編碼的 SSE 訊框)，所有連線共用
+SSE_KEEPALIVE = b": keepalive\n\n"  # 沒有新數據時送出的註解訊框，避免代理中斷閒置連線
 
-async def get_db_connection():
-    """建立資料庫連接"""
+# 查詢語句維持為模組層級常數，asyncpg 會依查詢字串快取已準備的語句
+LATEST_DATA_QUERY = """
+SELECT timestamp, ph_value, orp_value, ntu_value 
+FROM sensor_readings 
+ORDER BY timestamp DESC 
+LIMIT 1
+"""
+
+ALL_DATA_QUERY = """
+SELECT timestamp, ph_value, orp_value, ntu_value 
+FROM sensor_readings 
+ORDER BY timestamp DESC 
+LIMIT $1
+"""
+
+# /data 端點以單一查詢同時取得最新數據與總記錄數
+# （使用純量子查詢而非 COUNT(*) OVER ()，最新一筆仍可走 timestamp 索引）
+LATEST_DATA_WITH_COUNT_QUERY = """
+SELECT timestamp, ph_value, orp_value, ntu_value, 
+       (SELECT COUNT(*) FROM sensor_readings) AS total_records
+FROM sensor_readings 
+ORDER BY timestamp DESC 
+LIMIT 1
+"""
+
+TOTAL_COUNT_QUERY = "SELECT COUNT(*) FROM sensor_readings"
+
+# 連線池設定
+POOL_OPTIONS = {
+    "min_size": 2,
+    "max_size": 10,
+    "max_inactive_connection_lifetime": 600,
+    "statement_cache_size": 1024
+}
+
+async def init_connection(conn):
+    """新連線的初始化：numeric 欄位直接解碼為 float，可直接輸出為 JSON 數值"""
+    await conn.set_type_codec(
+        'numeric', encoder=str, decoder=float, schema='pg_catalog', format='text'
+    )
+
+# 連線池（於應用程式啟動時建立；啟動時無法連線則於之後的請求中重試）
+pool: Optional[asyncpg.Pool] = None
+pool_lock = asyncio.Lock()
+pool_retry_interval = 5  # 連線池建立失敗後，至少間隔多久再重試（秒）
+last_pool_attempt: Optional[float] = None  # time.monotonic() 時間
+
+# LISTEN/NOTIFY 設定：寫入端提交後會發送 NOTIFY sensor_new
+NOTIFY_CHANNEL = "sensor_new"
+listen_fallback_interval = 30  # 沒有收到通知時，回退為輪詢的間隔（秒）
+listener_conn: Optional[asyncpg.Connection] = None
+listener_task: Optional[asyncio.Task] = None  # 監聽中斷後重新建立監聽的背景工作
+subscribers: Set[asyncio.Queue] = set()
+
+async def init_pool():
+    """建立資料庫連線池"""
+    global pool, last_pool_attempt
+    last_pool_attempt = time.monotonic()
     try:
         if isinstance(DATABASE_CONFIG, str):
-            # 如果是資料庫URL，使用asyncpg的connect方法
-            conn = await asyncpg.connect(DATABASE_CONFIG)
+            # 如果是資料庫URL，直接作為 dsn 傳入
+            pool = await asyncpg.create_pool(
+                DATABASE_CONFIG, init=init_connection, **POOL_OPTIONS
+            )
         else:
-            # 如果是字典格式的資料庫配置，使用asyncpg的connect方法
-            conn = await asyncpg.connect(**DATABASE_CONFIG)
-        return conn
+            # 如果是字典格式的資料庫配置，展開為關鍵字參數
+            pool = await asyncpg.create_pool(
+                **DATABASE_CONFIG, init=init_connection, **POOL_OPTIONS
+            )
     except Exception as e:
-        print(f"資料庫連接失敗: {e}")
-        return None
+        print(f"資料庫連線池建立失敗: {e}")
+        pool = None
+        return
+    
+    await start_listener()
+
+def pool_retry_due() -> bool:
+    """連線池尚未建立，且距離上次嘗試已超過重試間隔"""
+    return pool is None and (
+        last_pool_attempt is None or
+        time.monotonic() - last_pool_attempt >= pool_retry_interval
+    )
+
+async def get_pool() -> Optional[asyncpg.Pool]:
+    """取得連線池；尚未建立時重新嘗試（以鎖避免同時建立多個連線池）"""
+    if pool_retry_due():
+        async with pool_lock:
+            if pool_retry_due():
+                await init_pool()
+    return pool
+
+async def close_pool():
+    """關閉資料庫連線池"""
+    global pool
+    await stop_listener()
+    if pool:
+        await pool.close()
+        pool = None
+
+def on_sensor_notify(connection, pid, channel, payload):
+    """收到新資料通知時，使快取失效並推送給所有 SSE 訂閱者"""
+    global cached_data
+    cached_data = None
+    # 只解析一次，所有訂閱者共用同一份資料
+    latest_data = json.loads(payload)
+    for queue in list(subscribers):
+        queue.put_nowait(latest_data)
+
+async def start_listener():
+    """從連線池取出一條專用連線來 LISTEN 新資料通知"""
+    global listener_conn
+    try:
+        listener_conn = await pool.acquire()
+        await listener_conn.add_listener(NOTIFY_CHANNEL, on_sensor_notify)
+        listener_conn.add_termination_listener(on_listener_terminated)
+    except Exception as e:
+        print(f"建立資料通知監聽失敗: {e}")
+        if listener_conn:
+            await pool.release(listener_conn)
+        listener_conn = None
+
+def listener_active() -> bool:
+    """監聽連線是否仍可接收通知"""
+    return listener_conn is not None and not listener_conn.is_closed()
+
+def on_listener_terminated(connection):
+    """監聽連線中斷（資料庫重啟、閒置連線被切斷）時，於背景重新建立監聽"""
+    print("資料通知監聽連線中斷，改為輪詢並重新建立監聽")
+    ensure_listener()
+
+def ensure_listener():
+    """連線池可用但監聽未啟用時，啟動重新監聽的背景工作（已在執行時不重複啟動）"""
+    global listener_task
+    if pool and not listener_active() and (listener_task is None or listener_task.done()):
+        listener_task = asyncio.get_running_loop().create_task(restart_listener())
+
+async def restart_listener():
+    """歸還已中斷的監聽連線，並持續重試直到重新監聽成功"""
+    global listener_conn
+    while pool and not listener_active():
+        if listener_conn:
+            try:
+                await pool.release(listener_conn)
+            except Exception as e:
+                print(f"歸還中斷的監聽連線失敗: {e}")
+            listener_conn = None
+        
+        await start_listener()
+        if not listener_active():
+            await asyncio.sleep(cache_duration)
+
+async def stop_listener():
+    """停止監聽並將連線歸還連線池"""
+    global listener_conn, listener_task
+    if listener_task:
+        listener_task.cancel()
+        listener_task = None
+    if listener_conn:
+        try:
+            listener_conn.remove_termination_listener(on_listener_terminated)
+            await listener_conn.remove_listener(NOTIFY_CHANNEL, on_sensor_notify)
+            await pool.release(listener_conn)
+        except Exception as e:
+            print(f"停止資料通知監聽失敗: {e}")
+        listener_conn = None
+
+def format_row(row) -> Dict[str, Any]:
+    """將查詢結果的一列轉換為回應格式"""
+    return {
+        "timestamp": row['timestamp'].isoformat() if row['timestamp'] else None,
+        "ph_value": row['ph_value'],
+        "orp_value": row['orp_value'],
+        "ntu_value": row['ntu_value']
+    }
 
 async def read_latest_data():
     """讀取最新的感測器數據"""
     global cached_data, last_cache_time
     
-    # 檢查快取是否有效
-    current_time = datetime.now()
-    if (cached_data and last_cache_time and 
-        (current_time - last_cache_time).total_seconds() < cache_duration):
+    # 檢查快取是否有效（使用單調時鐘，不需建立 datetime/timedelta）
+    now_mono = time.monotonic()
+    if (cached_data and last_cache_time is not None and 
+        now_mono - last_cache_time < cache_duration):
         return cached_data
     
-    conn = await get_db_connection()
-    if not conn:
+    if not await get_pool():
         return {"error": "無法連接到資料庫"}
     
     try:
         # 查詢最新數據
-        query = """
-        SELECT timestamp, ph_value, orp_value, ntu_value 
-        FROM sensor_readings 
-        ORDER BY timestamp DESC 
-        LIMIT 1
-        """
-        
-        row = await conn.fetchrow(query)
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(LATEST_DATA_QUERY)
         
         if not row:
             return {"message": "資料庫中沒有數據", "data": []}
@@ -86,52 +243,53 @@ async def read_latest_data():
         # 格式化結果
         result = {
             "status": "success",
-            "latest_data": {
-                "timestamp": row['timestamp'].isoformat() if row['timestamp'] else None,
-                "ph_value": str(row['ph_value']) if row['ph_value'] is not None else None,
-                "orp_value": str(row['orp_value']) if row['orp_value'] is not None else None,
-                "ntu_value": str(row['ntu_value']) if row['ntu_value'] is not None else None
-            },
-            "last_updated": current_time.isoformat()
+            "latest_data": format_row(row),
+            "last_updated": datetime.now().isoformat()
         }
         
         # 更新快取
         cached_data = result
-        last_cache_time = current_time
+        last_cache_time = now_mono
         
         return result
         
     except Exception as e:
         return {"error": f"讀取數據時發生錯誤: {str(e)}"}
-    finally:
-        await conn.close()
+
+async def read_latest_data_with_count():
+    """讀取最新的感測器數據與總記錄數（單一查詢）"""
+    if not await get_pool():
+        return {"error": "無法連接到資料庫"}
+    
+    try:
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow(LATEST_DATA_WITH_COUNT_QUERY)
+        
+        if not row:
+            return {"message": "資料庫中沒有數據", "data": [], "total_records": 0}
+        
+        return {
+            "status": "success",
+            "latest_data": format_row(row),
+            "last_updated": datetime.now().isoformat(),
+            "total_records": row['total_records']
+        }
+        
+    except Exception as e:
+        return {"error": f"讀取數據時發生錯誤: {str(e)}"}
 
 async def read_all_data(limit: int = 1000):
     """讀取所有歷史數據"""
-    conn = await get_db_connection()
-    if not conn:
+    if not await get_pool():
         return {"error": "無法連接到資料庫"}
     
     try:
         # 查詢歷史數據（限制數量避免過多）
-        query = """
-        SELECT timestamp, ph_value, orp_value, ntu_value 
-        FROM sensor_readings 
-        ORDER BY timestamp DESC 
-        LIMIT $1
-        """
-        
-        rows = await conn.fetch(query, limit)
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(ALL_DATA_QUERY, limit)
         
         # 格式化結果
-        parsed_data = []
-        for row in rows:
-            parsed_data.append({
-                "timestamp": row['timestamp'].isoformat() if row['timestamp'] else None,
-                "ph_value": str(row['ph_value']) if row['ph_value'] is not None else None,
-                "orp_value": str(row['orp_value']) if row['orp_value'] is not None else None,
-                "ntu_value": str(row['ntu_value']) if row['ntu_value'] is not None else None
-            })
+        parsed_data = [format_row(row) for row in rows]
         
         return {
             "status": "success",
@@ -142,37 +300,64 @@ async def read_all_data(limit: int = 1000):
         
     except Exception as e:
         return {"error": f"讀取數據時發生錯誤: {str(e)}"}
-    finally:
-        await conn.close()
 
 async def get_total_count():
-    """獲取資料庫中的總記錄數"""
-    conn = await get_db_connection()
-    if not conn:
+    """獲取資料庫中的總記錄數（管理用途，/data 已改用 read_latest_data_with_count）"""
+    if not await get_pool():
         return 0
     
     try:
-        query = "SELECT COUNT(*) FROM sensor_readings"
-        result = await conn.fetchval(query)
+        async with pool.acquire() as conn:
+            result = await conn.fetchval(TOTAL_COUNT_QUERY)
         return result or 0
     except Exception as e:
         print(f"獲取總數時發生錯誤: {e}")
         return 0
-    finally:
-        await conn.close()
 
 @router.get("/data")
 async def get_data():
     """原有的API端點，用於一次性獲取數據"""
-    result = await read_latest_data()
+    result = await read_latest_data_with_count()
     if "error" in result:
         raise HTTPException(status_code=500, detail=result["error"])
+    return result
+
+async def wait_for_latest_data(queue: asyncio.Queue):
+    """等待新資料通知；逾時或未啟用監聽時回退為查詢資料庫"""
+    # 監聽中斷時以較短的間隔輪詢，直到重新監聽成功
+    if listener_active():
+        timeout = listen_fallback_interval
+    else:
+        ensure_listener()
+        timeout = cache_duration
+    try:
+        latest_data = await asyncio.wait_for(queue.get(), timeout)
+    except asyncio.TimeoutError:
+        return await read_latest_data()
+    return {"latest_data": latest_data}
+
+def get_replace_frame(latest_data: Dict[str, Any], last_updated: Optional[str] = None):
+    """取得最新數據的 SSE 訊框；數據未變化時直接重用已編碼的 bytes"""
+    global replace_frame_cache
     
-    # 添加總記錄數
-    total_count = await get_total_count()
-    result["total_records"] = total_count
+    if latest_data.get("timestamp"):
+        data_key = latest_data["timestamp"]
+    else:
+        data_key = str(latest_data)
     
-    return result
+    if replace_frame_cache and replace_frame_cache[0] == data_key:
+        return replace_frame_cache
+    
+    # 建立簡化的回應
+    replace_response = {
+        "latest_data": latest_data,
+        # 優先沿用查詢結果內已產生的時間字串
+        "timestamp": last_updated or datetime.now().isoformat(),
+        "status": "success"
+    }
+    json_data = json.dumps(replace_response, ensure_ascii=False)
+    replace_frame_cache = (data_key, f"data: {json_data}\n\n".encode("utf-8"))
+    return replace_frame_cache
 
 @router.get("/replace")
 async def stream_data_with_replace():
@@ -182,55 +367,53 @@ async def stream_data_with_replace():
     async def event_generator():
         nonlocal last_sent_replace_data
         
-        while True:
-            try:
-                # 讀取最新數據
-                data = await read_latest_data()
-                
-                if "error" in data:
-                    # 發送錯誤訊息
+        # 訂閱新資料通知
+        queue = asyncio.Queue()
+        subscribers.add(queue)
+        
+        try:
+            # 先送出目前最新數據
+            data = await read_latest_data()
+            
+            while True:
+                try:
+                    if "error" in data:
+                        # 發送錯誤訊息
+                        error_response = {
+                            "error": data["error"], 
+                            "timestamp": datetime.now().isoformat()
+                        }
+                        json_data = json.dumps(error_response, ensure_ascii=False)
+                        yield f"data: {json_data}\n\n"
+                    elif "latest_data" in data:
+                        # 只在數據有變化時發送
+                        current_data_key, frame = get_replace_frame(
+                            data["latest_data"], data.get("last_updated")
+                        )
+                        if current_data_key != last_sent_replace_data:
+                            yield frame
+                            last_sent_replace_data = current_data_key
+                        else:
+                            # 等待逾時且數據沒有變化：送出 keepalive，避免代理中斷閒置連線
+                            yield SSE_KEEPALIVE
+                    else:
+                        # 尚無數據（例如資料庫為空）
+                        yield SSE_KEEPALIVE
+                    
+                    # 等待下一筆新資料
+                    data = await wait_for_latest_data(queue)
+                    
+                except Exception as e:
                     error_response = {
-                        "error": data["error"], 
+                        "error": f"串流發生錯誤: {str(e)}", 
                         "timestamp": datetime.now().isoformat()
                     }
                     json_data = json.dumps(error_response, ensure_ascii=False)
                     yield f"data: {json_data}\n\n"
                     await asyncio.sleep(5)
-                    continue
-                
-                # 檢查數據是否有變化
-                current_data_key = None
-                if "latest_data" in data:
-                    latest_data = data["latest_data"]
-                    if "timestamp" in latest_data and latest_data["timestamp"]:
-                        current_data_key = latest_data["timestamp"]
-                    else:
-                        current_data_key = str(latest_data)
-                
-                # 只在數據有變化時發送
-                if current_data_key != last_sent_replace_data:
-                    # 建立簡化的回應
-                    replace_response = {
-                        "latest_data": data["latest_data"],
-                        "timestamp": datetime.now().isoformat(),
-                        "status": "success"
-                    }
-                    
-                    json_data = json.dumps(replace_response, ensure_ascii=False)
-                    yield f"data: {json_data}\n\n"
-                    
-                    last_sent_replace_data = current_data_key
-                
-                await asyncio.sleep(5)  # 調整檢查頻率
-                
-            except Exception as e:
-                error_response = {
-                    "error": f"串流發生錯誤: {str(e)}", 
-                    "timestamp": datetime.now().isoformat()
-                }
-                json_data = json.dumps(error_response, ensure_ascii=False)
-                yield f"data: {json_data}\n\n"
-                await asyncio.sleep(5)
+                    data = await read_latest_data()
+        finally:
+            subscribers.discard(queue)
     
     return StreamingResponse(
         event_generator(),
@@ -255,16 +438,13 @@ async def get_all_data(limit: int = 1000):
 @router.get("/health")
 async def health_check():
     """健康檢查端點"""
-    conn = await get_db_connection()
-    if not conn:
+    if not await get_pool():
         raise HTTPException(status_code=503, detail="資料庫連接失敗")
     
     try:
         # 測試查詢
-        await conn.fetchval("SELECT 1")
-        await conn.close()
+        async with pool.acquire() as conn:
+            await conn.fetchval("SELECT 1")
         return {"status": "healthy", "database": "connected"}
     except Exception as e:
-        if conn:
-            await conn.close()
         raise HTTPException(status_code=503, detail=f"資料庫錯誤: {str(e)}")
\ No newline at end of file
@@ -1,199 +1,433 @@
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 import os
-import json
+import orjson
 import asyncio
 from datetime import datetime
 import time
+import mmap
+import threading
+from collections import deque
+from watchfiles import awatch
 
 router = APIRouter()
 
-# 檔案路徑常數
-DATA_FILE_PATH = "static\\sensor_readings.txt"
+# 檔案路徑常數（以 os.path.join 組合，Linux 與 Windows 皆可使用）
+DATA_FILE_PATH = os.path.join("static", "sensor_readings.txt")
 
-# 儲存上次讀取的檔案修改時間
-last_modified_time = None
+# 數據檔案只開啟一次，之後以 pread 存取，不需每次開關檔；路徑指向的檔案被替換時重新開啟
+# Windows 上以 os.open 開啟的檔案沒有 FILE_SHARE_DELETE，持有描述子會讓寫入端無法刪除或
+# 更名檔案，因此 Windows 上每次讀取完即關閉，下次讀取時再開啟
+KEEP_DATA_FILE_OPEN = os.name != 'nt'
+data_file_fd = None
+data_file_id = None  # 已開啟檔案的 (st_dev, st_ino)
+seek_lock = threading.Lock()  # 沒有 os.pread 的平台（Windows）以 lseek + read 代替
+file_lock = asyncio.Lock()    # 避免多個請求同時更新增量解析的狀態
+
+# 沒有新數據時，每隔多久送出一次 SSE keepalive（秒）
+KEEPALIVE_INTERVAL = 15
+
+# 檔案監看與推送：由單一背景工作監看檔案，讀取一次後推送給所有 SSE 連線
+# 在 NFS/CIFS 等收不到檔案事件的環境，可設定環境變數 WATCHFILES_FORCE_POLLING 改用輪詢
+subscribers = set()
+publisher_task = None
+publisher_stop_event = None
+
+# SSE 訊息的固定前後綴，預先編碼為 bytes
+SSE_DATA_PREFIX = b"data: "
+SSE_DATA_SUFFIX = b"\n\n"
+SSE_KEEPALIVE = b": keepalive\n\n"
+
+# 最近一次推送的 SSE 訊息（已編碼），所有連線共用，不需每個連線各自序列化
+last_frame = None
+last_frame_key = None
+
+# 儲存上次讀取的檔案 (st_dev, st_ino, 修改時間 ns, 大小)，同一秒內的追加也能以大小變化偵測
+last_modified_key = None
 cached_data = None
-last_sent_data = None  # 新增：儲存上次發送的數據
 
-def read_data_file():
-    """讀取數據檔案"""
-    global last_modified_time, cached_data
+# read_all_data 的快取：保留最近已解析的記錄，檔案增長時只解析新增的部分
+MAX_CACHED_RECORDS = 10000
+all_last_modified_key = None
+all_cached_data = None
+all_file_inode = None   # 用來偵測檔案被替換（輪替）
+all_parsed_offset = 0   # 已解析到的位置（最後一個換行之後）
+all_parsed_count = 0    # all_parsed_offset 之前的記錄總數
+all_parsed_records = deque(maxlen=MAX_CACHED_RECORDS)  # 最近已解析的記錄
+
+# 記錄數統計：檔案只會附加寫入，只需統計新增的部分
+counted_file_id = None  # 已統計檔案的 (st_dev, st_ino)，檔案被替換時重新統計
+counted_offset = 0   # 已統計到的位置（最後一個換行之後）
+counted_records = 0  # counted_offset 之前的非空行數
+
+def open_data_file():
+    """取得數據檔案的描述子與狀態；路徑指向的檔案被替換（輪替、刪除後重建）時重新開啟
+    
+    檔案不存在時拋出 FileNotFoundError。
+    """
+    global data_file_fd, data_file_id
+    
+    # 以路徑 stat 一次即可同時得知檔案狀態與是否已被替換
+    file_stat = os.stat(DATA_FILE_PATH)
+    if data_file_fd is not None and data_file_id == (file_stat.st_dev, file_stat.st_ino):
+        return data_file_fd, file_stat
     
+    close_data_file()
+    data_file_fd = os.open(DATA_FILE_PATH, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+    file_stat = os.fstat(data_file_fd)
+    data_file_id = (file_stat.st_dev, file_stat.st_ino)
+    return data_file_fd, file_stat
+
+def close_data_file():
+    """關閉已開啟的數據檔案"""
+    global data_file_fd, data_file_id
+    if data_file_fd is not None:
+        os.close(data_file_fd)
+        data_file_fd = None
+        data_file_id = None
+
+def release_data_file():
+    """讀取完畢；不保留描述子的平台（Windows）在此關閉檔案"""
+    if not KEEP_DATA_FILE_OPEN:
+        close_data_file()
+
+# 啟動時先開啟檔案；檔案尚未建立時於第一次讀取時再開啟
+if KEEP_DATA_FILE_OPEN:
     try:
-        if not os.path.exists(DATA_FILE_PATH):
-            return {"error": "數據檔案未找到"}
-        
-        # 檢查檔案修改時間
-        current_modified_time = os.path.getmtime(DATA_FILE_PATH)
-        
-        # 如果檔案沒有更新且有快取，返回快取數據
-        if last_modified_time == current_modified_time and cached_data:
-            return cached_data
-        
-        # 讀取檔案
-        with open(DATA_FILE_PATH, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-        
-        data_lines = [line.strip() for line in lines if line.strip()]
-        
-        if not data_lines:
-            return {"message": "檔案為空", "data": []}
-        
-        # 解析最新數據
-        latest_line = data_lines[-1]
-        
-        try:
-            parts = latest_line.split(', ')
-            if len(parts) >= 3:
-                timestamp = parts[0]
-                ph_value = parts[1]
-                orp_value = parts[2]
+        open_data_file()
+    except OSError:
+        pass
+
+def pread(fd, size, offset):
+    """從指定位置讀取，不改變其他讀取者使用的檔案位置"""
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+def read_last_line(fd, size):
+    """從檔案尾端往回讀取最後一個非空行（bytes）"""
+    chunk_size = 4096
+    while True:
+        start = max(0, size - chunk_size)
+        buf = pread(fd, size - start, start).rstrip()
+        newline_pos = buf.rfind(b'\n')
+        # 找到完整的最後一行，或已讀到檔案開頭
+        if newline_pos != -1 or start == 0:
+            return buf[newline_pos + 1:].strip()
+        chunk_size *= 2
+
+def count_records(fd, size, offset, records):
+    """從 offset（之前已有 records 筆）繼續統計非空行數，只讀取新增的位元組
+    
+    不修改全域狀態，返回 (新的 offset, 新的 records, 含結尾未換行部分的總數)，
+    由事件迴圈上的呼叫端更新統計狀態。
+    """
+    buf = pread(fd, size - offset, offset)
+    
+    # 只將完整的行計入，最後未換行的部分下次再統計
+    end = buf.rfind(b'\n') + 1
+    # isspace 只做判斷，不像 strip 需為每一行建立新的 bytes
+    records += sum(1 for line in buf[:end].split(b'\n') if line and not line.isspace())
+    offset += end
+    
+    partial = buf[end:]
+    return offset, records, records + (1 if partial and not partial.isspace() else 0)
+
+def read_latest_line(fd, size, offset, records):
+    """返回 (新的 offset, 新的 records, 非空行數, 最後一個非空行)"""
+    offset, records, total_records = count_records(fd, size, offset, records)
+    if not total_records:
+        return offset, records, 0, None
+    return offset, records, total_records, read_last_line(fd, size)
+
+async def run_file_worker(func, *args):
+    """在執行緒中讀取檔案
+    
+    執行緒無法中途停止；呼叫端被取消（例如 SSE 連線中斷）時仍等它結束，
+    才釋放 file_lock 與描述子，避免下一個請求與仍在執行的執行緒同時讀取。
+    """
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await asyncio.wait([future])
+        raise
+
+async def read_data_file():
+    """讀取數據檔案，失敗時拋出 HTTPException"""
+    global last_modified_key, cached_data
+    global counted_file_id, counted_offset, counted_records
+    
+    try:
+        async with file_lock:
+            # 取得已開啟的檔案與其狀態，只需一次 stat
+            try:
+                fd, file_stat = open_data_file()
+            except FileNotFoundError:
+                raise HTTPException(status_code=500, detail="數據檔案未找到")
+            
+            try:
+                # 檢查檔案修改時間與大小
+                current_modified_key = (file_stat.st_dev, file_stat.st_ino,
+                                        file_stat.st_mtime_ns, file_stat.st_size)
                 
+                # 如果檔案沒有更新且有快取，返回快取數據
+                if last_modified_key == current_modified_key and cached_data:
+                    return cached_data
+                
+                # 檔案被替換或變小（截斷），重新統計
+                file_id = (file_stat.st_dev, file_stat.st_ino)
+                if file_id != counted_file_id or file_stat.st_size < counted_offset:
+                    counted_file_id = file_id
+                    counted_offset = 0
+                    counted_records = 0
+                
+                # 在執行緒中讀取檔案尾端，不需讀取整個檔案；取得結果後才更新統計狀態
+                counted_offset, counted_records, total_records, latest_line = await run_file_worker(
+                    read_latest_line, fd, file_stat.st_size, counted_offset, counted_records
+                )
+                if not total_records:
+                    return {"message": "檔案為空", "data": []}
+                
+                # 解析最新數據
                 result = {
                     "status": "success",
-                    "latest_data": {
-                        "timestamp": timestamp,
-                        "ph_value": ph_value,
-                        "orp_value": orp_value
-                    },
-                    "total_records": len(data_lines),
-                    "last_updated": datetime.now().isoformat()
-                }
-            else:
-                result = {
-                    "status": "success",
-                    "latest_data": {
-                        "data": latest_line
-                    },
-                    "total_records": len(data_lines),
+                    "latest_data": parse_line(latest_line),
+                    "total_records": total_records,
                     "last_updated": datetime.now().isoformat()
                 }
-        except Exception:
-            result = {
-                "status": "success",
-                "latest_data": {
-                    "data": latest_line
-                },
-                "total_records": len(data_lines),
-                "last_updated": datetime.now().isoformat()
-            }
-        
-        # 更新快取
-        last_modified_time = current_modified_time
-        cached_data = result
-        
-        return result
+                
+                # 更新快取
+                last_modified_key = current_modified_key
+                cached_data = result
+                
+                return result
+            finally:
+                release_data_file()
         
+    except HTTPException:
+        raise
     except Exception as e:
-        return {"error": f"讀取檔案時發生錯誤: {str(e)}"}
+        raise HTTPException(status_code=500, detail=f"讀取檔案時發生錯誤: {str(e)}")
 
-def read_all_data():
-    """讀取所有歷史數據"""
-    try:
-        if not os.path.exists(DATA_FILE_PATH):
-            return {"error": "數據檔案未找到"}
-        
-        with open(DATA_FILE_PATH, 'r', encoding='utf-8') as file:
-            lines = file.readlines()
-        
-        data_lines = [line.strip() for line in lines if line.strip()]
+def read_lines_mmap(fd, size, offset=0):
+    """以 mmap 從 offset 讀取檔案並切分為行（省去複製整個檔案到 Python 的步驟）
+    
+    返回 (完整的非空行 bytes, 最後一個換行之後的位置, 結尾未換行的部分或 None)。
+    """
+    # 空檔案無法建立 mmap
+    if size == 0:
+        return [], 0, None
+    
+    with mmap.mmap(fd, size, access=mmap.ACCESS_READ) as mm:
+        # 純循序讀取，提示核心積極預讀並盡快釋放已讀頁面（僅部分平台支援）
+        if hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
         
-        # 解析所有數據
-        parsed_data = []
-        for line in data_lines:
+        buf = mm[offset:]
+    
+    # 寫入中的最後一行（沒有換行）不計入已解析位置
+    end = buf.rfind(b'\n') + 1
+    partial_line = buf[end:].strip() or None
+    # splitlines 與 strip 都在 C 層執行
+    data_lines = [stripped for line in buf[:end].splitlines() if (stripped := line.strip())]
+    return data_lines, offset + end, partial_line
+
+def parse_line(line):
+    """解析一行記錄（bytes），只解碼需要回傳的欄位"""
+    # 只需前三個欄位；多切一次讓第三個欄位不會帶上之後的內容
+    parts = line.split(b', ', 3)
+    if len(parts) >= 3:
+        # 感測器記錄只有 ASCII（時間與數值），非 ASCII 的行視為格式不符
+        try:
+            return {
+                "timestamp": parts[0].decode('ascii'),
+                "ph_value": parts[1].decode('ascii'),
+                "orp_value": parts[2].decode('ascii')
+            }
+        except UnicodeDecodeError:
+            pass
+    return {"data": line.decode('utf-8', 'replace')}
+
+async def read_all_data():
+    """讀取所有歷史數據，失敗時拋出 HTTPException"""
+    global all_last_modified_key, all_cached_data, all_file_inode
+    global all_parsed_offset, all_parsed_count
+    
+    try:
+        async with file_lock:
+            # 取得已開啟的檔案與其狀態，只需一次 stat
             try:
-                parts = line.split(', ')
-                if len(parts) >= 3:
-                    parsed_data.append({
-                        "timestamp": parts[0],
-                        "ph_value": parts[1],
-                        "orp_value": parts[2]
-                    })
-                else:
-                    parsed_data.append({
-                        "data": line
-                    })
-            except Exception:
-                parsed_data.append({
-                    "data": line
-                })
-        
-        return {
-            "status": "success",
-            "data": parsed_data,
-            "total_records": len(data_lines),
-            "last_updated": datetime.now().isoformat()
-        }
+                fd, file_stat = open_data_file()
+            except FileNotFoundError:
+                raise HTTPException(status_code=500, detail="數據檔案未找到")
+            
+            try:
+                # 如果檔案沒有更新且有快取，返回快取數據
+                current_modified_key = (file_stat.st_dev, file_stat.st_ino,
+                                        file_stat.st_mtime_ns, file_stat.st_size)
+                if all_last_modified_key == current_modified_key and all_cached_data:
+                    return all_cached_data
+                
+                # 檔案被替換或變小（截斷），重新解析
+                if file_stat.st_ino != all_file_inode or file_stat.st_size < all_parsed_offset:
+                    all_file_inode = file_stat.st_ino
+                    all_parsed_offset = 0
+                    all_parsed_count = 0
+                    all_parsed_records.clear()
+                
+                # 以 mmap 只讀取新增的部分，於執行緒中執行避免阻塞事件迴圈
+                data_lines, all_parsed_offset, partial_line = await run_file_worker(
+                    read_lines_mmap, fd, file_stat.st_size, all_parsed_offset
+                )
+                
+                # 解析新增的數據（超出保留數量的舊記錄不需解析）
+                all_parsed_count += len(data_lines)
+                all_parsed_records.extend([parse_line(line) for line in data_lines[-MAX_CACHED_RECORDS:]])
+                
+                parsed_data = list(all_parsed_records)
+                total_records = all_parsed_count
+                if partial_line:
+                    parsed_data.append(parse_line(partial_line))
+                    total_records += 1
+                    if len(parsed_data) > MAX_CACHED_RECORDS:
+                        parsed_data = parsed_data[1:]
+                
+                result = {
+                    "status": "success",
+                    "data": parsed_data,
+                    "total_records": total_records,
+                    "last_updated": datetime.now().isoformat()
+                }
+                
+                # 更新快取
+                all_last_modified_key = current_modified_key
+                all_cached_data = result
+                
+                return result
+            finally:
+                release_data_file()
         
+    except HTTPException:
+        raise
     except Exception as e:
-        return {"error": f"讀取檔案時發生錯誤: {str(e)}"}
+        raise HTTPException(status_code=500, detail=f"讀取檔案時發生錯誤: {str(e)}")
 
 @router.get("/data")
 async def get_data():
     """原有的API端點，用於一次性獲取數據"""
-    result = read_data_file()
-    if "error" in result:
-        raise HTTPException(status_code=500, detail=result["error"])
-    return result
+    return await read_data_file()
+
+def error_frame(message):
+    """建立錯誤訊息的 SSE 訊息"""
+    error_response = {
+        "error": message,
+        "timestamp": datetime.now().isoformat()
+    }
+    return SSE_DATA_PREFIX + orjson.dumps(error_response) + SSE_DATA_SUFFIX
+
+def build_replace_frame(data):
+    """依讀取結果更新 last_frame；數據沒有變化時返回 None"""
+    global last_frame, last_frame_key
+    
+    # 檢查數據是否有變化
+    current_data_key = None
+    if "latest_data" in data:
+        latest_data = data["latest_data"]
+        if "timestamp" in latest_data:
+            current_data_key = latest_data["timestamp"]
+        else:
+            current_data_key = str(latest_data)
+    
+    # 只在數據有變化時發送
+    if current_data_key == last_frame_key and last_frame:
+        return None
+    
+    # 建立簡化的回應，移除多餘的包裝（沿用讀取結果內已產生的時間字串）
+    replace_response = {
+        "latest_data": data.get("latest_data"),
+        "timestamp": data.get("last_updated") or datetime.now().isoformat(),
+        "status": "success"
+    }
+    
+    last_frame_key = current_data_key
+    last_frame = SSE_DATA_PREFIX + orjson.dumps(replace_response) + SSE_DATA_SUFFIX
+    return last_frame
+
+async def read_replace_frame():
+    """讀取最新數據並建立 SSE 訊息；讀取失敗時返回錯誤訊息"""
+    try:
+        return build_replace_frame(await read_data_file())
+    except HTTPException as e:
+        return error_frame(e.detail)
+
+def broadcast(frame):
+    """將已編碼的 SSE 訊息推送給所有訂閱者"""
+    for queue in list(subscribers):
+        queue.put_nowait(frame)
+
+async def publish_file_changes(stop_event):
+    """監看數據檔案，有變更時讀取一次並推送給所有訂閱者"""
+    watch_path = os.path.abspath(DATA_FILE_PATH)
+    
+    while not stop_event.is_set():
+        try:
+            # 監看檔案所在資料夾，檔案有變更時才重新讀取
+            async for changes in awatch(
+                os.path.dirname(watch_path),
+                watch_filter=lambda change, path: os.path.abspath(path) == watch_path,
+                debounce=50,
+                stop_event=stop_event,
+                recursive=False
+            ):
+                frame = await read_replace_frame()
+                if frame:
+                    broadcast(frame)
+        except Exception as e:
+            broadcast(error_frame(f"串流發生錯誤: {str(e)}"))
+            await asyncio.sleep(5)
+
+def start_publisher():
+    """啟動檔案監看背景工作（已在執行時不重複啟動）"""
+    global publisher_task, publisher_stop_event
+    if publisher_task is None or publisher_task.done():
+        publisher_stop_event = asyncio.Event()
+        publisher_task = asyncio.create_task(publish_file_changes(publisher_stop_event))
+
+async def stop_publisher():
+    """停止檔案監看背景工作"""
+    global publisher_task
+    if publisher_task:
+        publisher_stop_event.set()
+        await publisher_task
+        publisher_task = None
 
 @router.get("/replace")
 async def stream_data_with_replace():
     """SSE端點，專門用於替換模式 - 只推送最新數據"""
-    last_sent_replace_data = None
-    
     async def event_generator():
-        nonlocal last_sent_replace_data
+        # 訂閱檔案變更推送
+        start_publisher()
+        queue = asyncio.Queue()
+        subscribers.add(queue)
         
-        while True:
-            try:
-                # 讀取最新數據
-                data = read_data_file()
-                
-                if "error" in data:
-                    # 發送錯誤訊息
-                    error_response = {
-                        "error": data["error"], 
-                        "timestamp": datetime.now().isoformat()
-                    }
-                    json_data = json.dumps(error_response, ensure_ascii=False)
-                    yield f"data: {json_data}\n\n"
-                    await asyncio.sleep(5)
-                    continue
-                
-                # 檢查數據是否有變化
-                current_data_key = None
-                if "latest_data" in data:
-                    latest_data = data["latest_data"]
-                    if "timestamp" in latest_data:
-                        current_data_key = latest_data["timestamp"]
-                    else:
-                        current_data_key = str(latest_data)
-                
-                # 只在數據有變化時發送
-                if current_data_key != last_sent_replace_data:
-                    # 建立簡化的回應，移除多餘的包裝
-                    replace_response = {
-                        "latest_data": data["latest_data"],
-                        "timestamp": datetime.now().isoformat(),
-                        "status": "success"
-                    }
-                    
-                    json_data = json.dumps(replace_response, ensure_ascii=False)
-                    yield f"data: {json_data}\n\n"
-                    
-                    last_sent_replace_data = current_data_key
-                
-                await asyncio.sleep(5)  # 調整檢查頻率
+        try:
+            # 先送出目前最新數據（尚無推送過的訊息時讀取一次）
+            frame = last_frame or await read_replace_frame()
+            
+            while True:
+                if frame:
+                    yield frame
                 
-            except Exception as e:
-                error_response = {
-                    "error": f"串流發生錯誤: {str(e)}", 
-                    "timestamp": datetime.now().isoformat()
-                }
-                json_data = json.dumps(error_response, ensure_ascii=False)
-                yield f"data: {json_data}\n\n"
-                await asyncio.sleep(5)
+                # 等待下一次推送；逾時則送出 keepalive 避免連線被代理中斷
+                try:
+                    frame = await asyncio.wait_for(queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    frame = SSE_KEEPALIVE
+        finally:
+            subscribers.discard(queue)
     
     return StreamingResponse(
         event_generator(),
@@ -210,7 +444,4 @@ async def stream_data_with_replace():
 @router.get("/data/all")
 async def get_all_data():
     """獲取所有歷史數據"""
-    result = read_all_data()
-    if "error" in result:
-        raise HTTPException(status_code=500, detail=result["error"])
-    return result
\ No newline at end of file
+    return await read_all_data()
\ No newline at end of file